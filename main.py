@@ -1,18 +1,47 @@
 import os
+import re
+import logging
+import hashlib
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from io import BytesIO
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException
+from typing import List, Dict, Any, Optional, Tuple, Union, AsyncIterator
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
 from pydantic import BaseModel, Field
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 from datetime import datetime, timezone
 
-from database import db, create_document
+from database import db, fs, create_document
 from bson import ObjectId
-from bson.binary import Binary
 
-app = FastAPI(title="Replix AI Backend", description="Generate Minecraft plugin projects as downloadable ZIPs")
+_OBJECT_ID = re.compile(r"[0-9a-fA-F]{24}").fullmatch
+
+logger = logging.getLogger(__name__)
+
+_HISTORY_INDEX = [("created_at", -1)]
+_HISTORY_FIELDS = {"plugin_name": 1, "package_name": 1, "description": 1, "api": 1, "archive_size": 1, "created_at": 1}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if db is not None:
+        try:
+            await db["generation"].create_index(_HISTORY_INDEX)
+        except Exception as e:
+            # Keep serving so /test can report the database state
+            logger.warning("Could not create generation.created_at index: %s", e)
+    yield
+
+
+app = FastAPI(
+    title="Replix AI Backend",
+    description="Generate Minecraft plugin projects as downloadable ZIPs",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +49,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let browsers cache preflight results instead of sending OPTIONS before every request
+    max_age=86400,
 )
 
 class CommandSpec(BaseModel):
@@ -35,38 +66,20 @@ class GenerateRequest(BaseModel):
     commands: List[CommandSpec] = Field(default_factory=list)
 
 
-def _plugin_yml(name: str, main_class: str, description: str, commands: List[CommandSpec]) -> str:
-    lines = [
-        f"name: {name}",
-        "version: 1.0.0",
-        "api-version: '1.20'",
-        f"main: {main_class}",
-        f"description: {description if description else name}",
-    ]
-    if commands:
-        lines.append("commands:")
-        for cmd in commands:
-            cname = cmd.name.strip()
-            if not cname:
-                continue
-            lines.append(f"  {cname}:")
-            if cmd.description:
-                lines.append(f"    description: {cmd.description}")
-            lines.append(f"    usage: /{cname}")
-            lines.append("    permission: replix." + cname)
-            lines.append("    permission-message: You don't have permission to use this command.")
-    return "\n".join(lines) + "\n"
-
-
-def _main_java(package_name: str, class_name: str, description: str, commands: List[CommandSpec]) -> str:
-    register_cmds = "\n".join([
-        f"        this.getCommand(\"{c.name}\").setExecutor(new {c.name.capitalize()}Command());" for c in commands if c.name
-    ])
-    imports_cmds = "\n".join([
-        f"import {package_name}.commands.{c.name.capitalize()}Command;" for c in commands if c.name
-    ])
-    return f"""
-package {package_name};
+_PLUGIN_YML_TMPL = """name: {name}
+version: 1.0.0
+api-version: '1.20'
+main: {main_class}
+description: {description}
+"""
+
+_PLUGIN_YML_CMD_TMPL = """  {name}:
+{description}    usage: /{name}
+    permission: replix.{name}
+    permission-message: You don't have permission to use this command.
+"""
+
+_MAIN_JAVA_TMPL = """package {package_name};
 
 import org.bukkit.plugin.java.JavaPlugin;
 {imports_cmds}
@@ -75,7 +88,7 @@ public class {class_name} extends JavaPlugin {{
 
     @Override
     public void onEnable() {{
-        getLogger().info("{description if description else class_name} enabled!");
+        getLogger().info("{description} enabled!");
 {register_cmds}
     }}
 
@@ -84,14 +97,12 @@ public class {class_name} extends JavaPlugin {{
         getLogger().info("{class_name} disabled!");
     }}
 }}
-""".strip() + "\n"
+"""
 
+_MAIN_JAVA_IMPORT_TMPL = "import {package_name}.commands.{Cap}Command;"
+_MAIN_JAVA_REGISTER_TMPL = "        this.getCommand(\"{name}\").setExecutor(new {Cap}Command());"
 
-def _command_java(package_name: str, cmd: CommandSpec) -> str:
-    class_name = f"{cmd.name.capitalize()}Command"
-    message = cmd.description or f"/{cmd.name} executed!"
-    return f"""
-package {package_name}.commands;
+_COMMAND_JAVA_TMPL = """package {package_name}.commands;
 
 import org.bukkit.command.Command;
 import org.bukkit.command.CommandExecutor;
@@ -105,45 +116,58 @@ public class {class_name} implements CommandExecutor {{
         return true;
     }}
 }}
-""".strip() + "\n"
+"""
 
 
-def build_plugin_zip(req: GenerateRequest) -> bytes:
-    pkg = req.package_name.strip()
-    if not pkg or "." not in pkg:
-        raise HTTPException(status_code=400, detail="package_name must be a valid Java package like com.example.plugin")
+# Normalized command: (name, capitalized name, description)
+NormalizedCommand = Tuple[str, str, Optional[str]]
 
-    main_class_name = "Main"
-    full_main_class = f"{pkg}.{main_class_name}"
 
-    buf = BytesIO()
-    with ZipFile(buf, mode="w", compression=ZIP_DEFLATED) as z:
-        # plugin.yml
-        z.writestr("plugin.yml", _plugin_yml(req.plugin_name, full_main_class, req.description, req.commands))
+def _normalize_commands(commands: List[CommandSpec]) -> List[NormalizedCommand]:
+    """Strip and capitalize command names once, dropping blank ones"""
+    cmds = []
+    for cmd in commands:
+        cname = (cmd.name or "").strip()
+        if cname:
+            cmds.append((cname, cname.capitalize(), cmd.description))
+    return cmds
 
-        # src structure
-        java_path = "src/main/java/" + pkg.replace(".", "/") + "/"
-        z.writestr(java_path + main_class_name + ".java", _main_java(pkg, main_class_name, req.description, req.commands))
 
-        # command executors
-        if req.commands:
-            commands_pkg_path = java_path + "commands/"
-            for cmd in req.commands:
-                cname = (cmd.name or "").strip()
-                if not cname:
-                    continue
-                z.writestr(commands_pkg_path + cname.capitalize() + "Command.java", _command_java(pkg, cmd))
+def _plugin_yml(name: str, main_class: str, description: str, cmds: List[NormalizedCommand]) -> str:
+    out = _PLUGIN_YML_TMPL.format_map({
+        "name": name,
+        "main_class": main_class,
+        "description": description if description else name,
+    })
+    if cmds:
+        out += "commands:\n" + "".join(
+            _PLUGIN_YML_CMD_TMPL.format(name=cname, description=f"    description: {cdesc}\n" if cdesc else "")
+            for cname, _, cdesc in cmds
+        )
+    return out
+
+
+def _main_java(package_name: str, class_name: str, description: str, cmds: List[NormalizedCommand]) -> str:
+    return _MAIN_JAVA_TMPL.format_map({
+        "package_name": package_name,
+        "class_name": class_name,
+        "description": description if description else class_name,
+        "imports_cmds": "\n".join(_MAIN_JAVA_IMPORT_TMPL.format(package_name=package_name, Cap=cap) for _, cap, _ in cmds),
+        "register_cmds": "\n".join(_MAIN_JAVA_REGISTER_TMPL.format(name=cname, Cap=cap) for cname, cap, _ in cmds),
+    })
 
-        # pom.xml minimal for Maven
-        pom = f"""
-<project xmlns="http://maven.apache.org/POM/4.0.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-    xsi:schemaLocation="http://maven.apache.org/POM/4.0.0 http://maven.apache.org/xsd/maven-4.0.0.xsd">
-  <modelVersion>4.0.0</modelVersion>
-  <groupId>{pkg}</groupId>
-  <artifactId>{req.plugin_name.lower().replace(' ', '-')}</artifactId>
-  <version>1.0.0</version>
-  <name>{req.plugin_name}</name>
-  <description>{req.description}</description>
+
+def _command_java(package_name: str, cmd: NormalizedCommand) -> str:
+    cname, cap, cdesc = cmd
+    return _COMMAND_JAVA_TMPL.format_map({
+        "package_name": package_name,
+        "class_name": f"{cap}Command",
+        "message": cdesc or f"/{cname} executed!",
+    })
+
+
+# Invariant part of pom.xml, kept out of the per-request template
+_POM_BUILD = """
   <build>
     <sourceDirectory>src/main/java</sourceDirectory>
     <plugins>
@@ -177,13 +201,86 @@ def build_plugin_zip(req: GenerateRequest) -> bytes:
     </repository>
   </repositories>
 </project>
-""".strip() + "\n"
-        z.writestr("pom.xml", pom)
+""".lstrip("\n")
+
+_POM_HEAD_TMPL = """<project xmlns="http://maven.apache.org/POM/4.0.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xsi:schemaLocation="http://maven.apache.org/POM/4.0.0 http://maven.apache.org/xsd/maven-4.0.0.xsd">
+  <modelVersion>4.0.0</modelVersion>
+  <groupId>{package_name}</groupId>
+  <artifactId>{artifact_id}</artifactId>
+  <version>1.0.0</version>
+  <name>{plugin_name}</name>
+  <description>{description}</description>
+"""
+
+_GITIGNORE = b".idea\n*.iml\n*.class\n/target\n"
+
+# Entries smaller than this are stored as-is; DEFLATE framing would cost more than it saves
+_STORE_BELOW = 200
+
+# Fixed entry timestamp (the DOS epoch) so identical requests produce byte-identical archives
+_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _pom_xml(package_name: str, plugin_name: str, description: str) -> str:
+    return _POM_HEAD_TMPL.format_map({
+        "package_name": package_name,
+        "artifact_id": plugin_name.lower().replace(' ', '-'),
+        "plugin_name": plugin_name,
+        "description": description,
+    }) + _POM_BUILD
+
+
+def _writestr(z: ZipFile, name: str, data: Union[str, bytes]) -> None:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    zinfo = ZipInfo(name, date_time=_ZIP_DATE_TIME)
+    zinfo.compress_type = ZIP_STORED if len(data) < _STORE_BELOW else ZIP_DEFLATED
+    zinfo.external_attr = 0o644 << 16
+    # An explicit ZipInfo does not inherit the archive's compresslevel
+    z.writestr(zinfo, data, compresslevel=z.compresslevel)
+
+
+def build_plugin_zip(req: GenerateRequest) -> Tuple[bytes, Tuple[str, ...]]:
+    """Render the project and return the ZIP bytes with the archive's file names"""
+    pkg = req.package_name.strip()
+    if not pkg or "." not in pkg:
+        raise HTTPException(status_code=400, detail="package_name must be a valid Java package like com.example.plugin")
+
+    main_class_name = "Main"
+    full_main_class = f"{pkg}.{main_class_name}"
+    cmds = _normalize_commands(req.commands)
+
+    buf = BytesIO()
+    # Entries are a few KB of generated text; level 1 is close to level 6 in size at a fraction of the CPU
+    with ZipFile(buf, mode="w", compression=ZIP_DEFLATED, compresslevel=1) as z:
+        # plugin.yml
+        _writestr(z, "plugin.yml", _plugin_yml(req.plugin_name, full_main_class, req.description, cmds))
+
+        # src structure
+        java_path = "src/main/java/" + pkg.replace(".", "/") + "/"
+        _writestr(z, java_path + main_class_name + ".java", _main_java(pkg, main_class_name, req.description, cmds))
+
+        # command executors
+        commands_pkg_path = java_path + "commands/"
+        for cmd in cmds:
+            _writestr(z, commands_pkg_path + cmd[1] + "Command.java", _command_java(pkg, cmd))
+
+        # pom.xml minimal for Maven
+        _writestr(z, "pom.xml", _pom_xml(pkg, req.plugin_name, req.description))
 
         # .gitignore
-        z.writestr(".gitignore", ".idea\n*.iml\n*.class\n/target\n")
+        _writestr(z, ".gitignore", _GITIGNORE)
+
+        files = tuple(z.namelist())
 
-    return buf.getvalue()
+    return buf.getvalue(), files
+
+
+@lru_cache(maxsize=512)
+def _build_plugin_zip_cached(payload: str) -> Tuple[bytes, Tuple[str, ...]]:
+    # Keyed on the request's canonical JSON so identical generations skip rendering and compression
+    return build_plugin_zip(GenerateRequest.model_validate_json(payload))
 
 
 @app.get("/")
@@ -191,34 +288,48 @@ def read_root():
     return {"message": "Replix AI Backend is running"}
 
 
+async def _save_generation(doc: Dict[str, Any], zip_bytes: bytes) -> None:
+    # Archives live in GridFS under their content hash; identical generations share one file
+    existing = await fs.find({"filename": doc["content_hash"]}).limit(1).to_list(1)
+    if existing:
+        doc["zip_id"] = existing[0]._id
+    else:
+        doc["zip_id"] = await fs.upload_from_stream(doc["content_hash"], zip_bytes)
+    await db["generation"].insert_one(doc)
+
+
+async def _iter_grid_out(grid_out) -> AsyncIterator[bytes]:
+    while chunk := await grid_out.readchunk():
+        yield chunk
+
+
 @app.post("/api/generate")
-def generate_plugin(req: GenerateRequest):
+async def generate_plugin(req: GenerateRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
 
-    zip_bytes = build_plugin_zip(req)
+    payload = req.model_dump_json()
+    # Rendering and compression are CPU-bound; keep them off the event loop
+    zip_bytes, files = await run_in_threadpool(_build_plugin_zip_cached, payload)
     size = len(zip_bytes)
 
+    oid = ObjectId()
     doc = {
-        "plugin_name": req.plugin_name,
-        "package_name": req.package_name,
-        "description": req.description,
-        "api": req.api,
-        "commands": [c.model_dump() for c in req.commands],
-        "files": [
-            "plugin.yml",
-            f"src/main/java/{req.package_name.replace('.', '/')}/Main.java",
-        ] + ([f"src/main/java/{req.package_name.replace('.', '/')}/commands/{c.name.capitalize()}Command.java" for c in req.commands if c.name] if req.commands else []),
+        "_id": oid,
+        # plugin_name, package_name, description, api and commands in a single dump
+        **req.model_dump(),
+        "files": list(files),
         "archive_size": size,
+        "content_hash": hashlib.blake2b(payload.encode(), digest_size=16).hexdigest(),
         "created_at": datetime.now(timezone.utc),
         "updated_at": datetime.now(timezone.utc),
-        "zip": Binary(zip_bytes),
     }
 
-    result = db["generation"].insert_one(doc)
-    gen_id = str(result.inserted_id)
+    # Awaited so the returned id always resolves; on motor this does not hold a worker thread
+    await _save_generation(doc, zip_bytes)
+    gen_id = str(oid)
 
-    return JSONResponse({
+    return ORJSONResponse({
         "id": gen_id,
         "archive_size": size,
         "download_url": f"/api/download/{gen_id}",
@@ -227,39 +338,49 @@ def generate_plugin(req: GenerateRequest):
 
 
 @app.get("/api/download/{gen_id}")
-def download_plugin(gen_id: str):
+async def download_plugin(gen_id: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    try:
-        oid = ObjectId(gen_id)
-    except Exception:
+    if not _OBJECT_ID(gen_id):
         raise HTTPException(status_code=400, detail="Invalid id")
+    oid = ObjectId(gen_id)
 
-    doc = db["generation"].find_one({"_id": oid})
-    if not doc or not doc.get("zip"):
+    doc = await db["generation"].find_one({"_id": oid}, {"plugin_name": 1, "zip_id": 1, "zip": 1})
+    if not doc or not (doc.get("zip_id") or doc.get("zip")):
         raise HTTPException(status_code=404, detail="Archive not found")
 
-    data: bytes = bytes(doc["zip"])  # Binary -> bytes
     filename = f"{doc.get('plugin_name','plugin').lower().replace(' ', '-')}.zip"
-    return StreamingResponse(BytesIO(data), media_type="application/zip", headers={
-        "Content-Disposition": f"attachment; filename={filename}"
-    })
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+
+    if doc.get("zip_id"):
+        grid_out = await fs.open_download_stream(doc["zip_id"])
+        headers["Content-Length"] = str(grid_out.length)
+        return StreamingResponse(_iter_grid_out(grid_out), media_type="application/zip", headers=headers)
+
+    # Older generations carry the archive inline
+    data: bytes = bytes(doc["zip"])  # Binary -> bytes
+    return Response(data, media_type="application/zip", headers=headers)
 
 
 @app.get("/api/history")
-def history(limit: int = 20):
+async def history(limit: int = Query(20, ge=1)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    items = db["generation"].find({}, {"zip": 0}).sort("created_at", -1).limit(limit)
-    result = []
-    for it in items:
+    cursor = (
+        db["generation"].find({}, _HISTORY_FIELDS)
+        .sort(_HISTORY_INDEX)
+        .limit(limit)
+        .batch_size(limit)
+    )
+    result = await cursor.to_list(limit)
+    for it in result:
         it["id"] = str(it.pop("_id"))
-        result.append(it)
-    return {"items": result}
+    # orjson encodes the datetimes natively, so skip FastAPI's jsonable_encoder pass
+    return ORJSONResponse({"items": result})
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -275,7 +396,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -293,4 +414,12 @@ def test_database():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        proxy_headers=True,
+    )